@@ -3,6 +3,7 @@ import numpy as np
 import os
 from exceptions import StatusException
 from handlers import report_error
+from memory_utils import track_memory, start_job, end_job, register_cleanup
 from preprocessing_utils import *
 from s3_utils import *
 from upscaling_utils import *
@@ -25,12 +26,34 @@ def init():
     # do the slow model initialization
     model.load_model()
 
+    # let the memory monitor drop cached clients when it cleans up
+    register_cleanup(clear_s3_clients)
+
 
 def inference(model_inputs: dict) -> dict:
     """
     Inference is run for every server call
     Reference your preloaded global model variable here.
     """
+    start_job()
+    response = None
+    try:
+        response = process_request(model_inputs)
+    finally:
+        # always close the job, even if the error path itself fails
+        memory_report = end_job()
+        if memory_report:
+            if isinstance(response, dict):
+                response['memoryReport'] = memory_report
+            else:
+                print("MEMORY REPORT:", memory_report)
+    return response
+
+
+def process_request(model_inputs: dict):
+    """
+    Run the pipeline for one request and turn errors into error codes
+    """
     global model
     try:
         # parse out inputs from request body
@@ -84,7 +107,7 @@ def main(composite_image, bg_image, n_imgs, model,
     # imgs = upscale_images(imgs)
 
     # saving the images
-    client = create_s3_client(os.environ["ACCESS"], os.environ["SECRET"])
+    client = get_s3_client(os.environ["ACCESS"], os.environ["SECRET"])
     keys = save_images(composite_id, imgs, client)
 
     if os.environ["ENV"] == "prod":
@@ -132,6 +155,7 @@ def img2img_main(
     return final_image
 
 
+@track_memory("generation")
 @report_error(210)
 def get_raw_generation(gr, prompt, image_with_alpha_transparency,
                        init_image_mask, ss=0, sb=0):
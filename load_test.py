@@ -0,0 +1,619 @@
+"""
+Replay a JSONL file of runpod events through handler.handler to measure
+throughput, tail latency and a per stage breakdown.
+
+Like a deployment, --concurrency starts that many worker processes, each
+loading its own handler and running one job at a time.
+
+Everything outside the workers is replaced by local stand-ins:
+  - a local HTTP server serves the composite/background images, the
+    uploaded S3 objects and the backend endpoint
+  - a local S3 stand-in uploads to that server and presigns urls for it
+  - a stub Generate sleeps according to a simple cost model
+
+Usage:
+    python load_test.py events.jsonl --requests 200 --rate 5 \
+        --concurrency 4 --output run.json --baseline previous_run.json
+"""
+import argparse
+import contextlib
+import json
+import math
+import multiprocessing
+import os
+import queue
+import random
+import sys
+import threading
+import time
+import types
+import urllib.request
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+
+from PIL import Image
+
+STAGES = [
+    ("download", "preprocessing_utils", "load_image_from_url"),
+    ("prepare_masks", "app", "prepare_masks_differencing_main"),
+    ("add_shadow", "app", "add_shadow"),
+    ("generation", "app", "get_raw_generation"),
+    ("upload", "app", "save_images"),
+    ("notify_backend", "app", "send_info_back_to_BE"),
+    ("presign", "app", "get_urls"),
+]
+
+DEFAULT_INPUT = {
+    "prompts": {
+        "image_specific_prompt": "product photo",
+        "extra_info_prompt": "high quality",
+        "background_prompt": "marble table",
+    },
+    "productDescription": "a bottle",
+    "productId": "product",
+    "backgroundId": "background",
+    "compositeProductId": "composite",
+    "nImages": 1,
+}
+
+# runs are only comparable when these are the same
+LOAD_PARAMS = ["events", "requests", "rate", "concurrency", "warmup",
+               "gen_base", "gen_per_step", "gen_jitter", "image_latency",
+               "backend_latency", "env", "memory_env"]
+
+# replaced with the local server's urls
+URL_INPUTS = ["compositeProductUrl", "backgroundUrl"]
+
+_local = threading.local()
+
+
+class CostModel:
+    """
+    Time spent by the stub Generate per prompt2image call
+    """
+    def __init__(self, base, per_step, jitter):
+        self.base = base
+        self.per_step = per_step
+        self.jitter = jitter
+
+    def sample(self, steps):
+        cost = self.base + self.per_step * steps
+        if self.jitter:
+            cost *= max(0.0, random.gauss(1.0, self.jitter))
+        return cost
+
+
+def make_stub_generate(cost_model):
+    """
+    Stand-in for ldm.generate.Generate which only sleeps and hands the
+    init image back
+    """
+    class Generate:
+        def __init__(self, *args, **kwargs):
+            pass
+
+        def load_model(self):
+            pass
+
+        def prompt2image(self, prompt, init_img=None, steps=50, seed=None,
+                         **kwargs):
+            time.sleep(cost_model.sample(steps))
+            output = init_img.copy() if init_img is not None \
+                else Image.new("RGB", (512, 512))
+            return [[output, seed]]
+    return Generate
+
+
+class LocalS3:
+    """
+    Stand-in for the boto3 S3 client used in s3_utils, storing the objects
+    on the local server
+    """
+    def __init__(self, base_url):
+        self.base_url = base_url
+
+    def list_buckets(self):
+        return {"Buckets": []}
+
+    def upload_fileobj(self, fileobj, bucket, key):
+        request = urllib.request.Request(
+            self._object_url(bucket, key), data=fileobj.read(), method="PUT")
+        urllib.request.urlopen(request).close()
+
+    def generate_presigned_url(self, method, Params, ExpiresIn=3600):
+        return "{}?X-Amz-Expires={}".format(
+            self._object_url(Params["Bucket"], Params["Key"]), ExpiresIn)
+
+    def _object_url(self, bucket, key):
+        return "{}s3/{}/{}".format(self.base_url, bucket, key)
+
+
+def make_test_images():
+    """
+    Background and composite (background with a product on it) as PNGs
+    """
+    background = Image.new("RGB", (512, 512), (205, 195, 180))
+    composite = background.copy()
+    composite.paste((60, 90, 120), (176, 136, 336, 416))
+    images = {}
+    for name, img in [("background", background), ("composite", composite)]:
+        buffer = BytesIO()
+        img.save(buffer, format="PNG")
+        images["/images/{}.png".format(name)] = buffer.getvalue()
+    return images
+
+
+def start_local_server(images, backend_latency, image_latency):
+    """
+    Serve images, S3 objects and the backend endpoint
+    """
+    backend_calls = []
+    objects = {}
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            path = self.path.split("?")[0]
+            if path in images:
+                time.sleep(image_latency)
+                body = images[path]
+            elif path.startswith("/s3/"):
+                body = objects.get(path)
+            else:
+                body = None
+            if body is None:
+                self.send_response(404)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "image/png")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_PUT(self):
+            length = int(self.headers.get("Content-Length", 0))
+            objects[self.path.split("?")[0]] = self.rfile.read(length)
+            self.send_response(200)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length", 0))
+            backend_calls.append(json.loads(self.rfile.read(length) or "{}"))
+            time.sleep(backend_latency)
+            self.send_response(200)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, backend_calls
+
+
+def load_worker(cost_model, base_url, env):
+    """
+    Import handler.py with the stubs in place and return its handler
+    """
+    os.environ.setdefault("ACCESS", "local")
+    os.environ.setdefault("SECRET", "local")
+    os.environ["ENDPOINT"] = base_url
+    os.environ["ENV"] = env
+
+    # app.py imports Generate and, through upscaling_utils, ESRGAN
+    stubs = {}
+    for name in ["ldm", "ldm.generate", "ldm.invoke",
+                 "ldm.invoke.restoration",
+                 "ldm.invoke.restoration.realesrgan"]:
+        module = types.ModuleType(name)
+        module.__path__ = []
+        stubs[name] = module
+        if "." in name:
+            parent, child = name.rsplit(".", 1)
+            setattr(stubs[parent], child, module)
+    stubs["ldm.generate"].Generate = make_stub_generate(cost_model)
+    stubs["ldm.invoke.restoration.realesrgan"].ESRGAN = object
+    runpod = types.ModuleType("runpod")
+    runpod.serverless = types.SimpleNamespace(start=lambda config: None)
+    stubs["runpod"] = runpod
+    sys.modules.update(stubs)
+
+    import handler
+    return handler
+
+
+def install_local_s3(s3):
+    import s3_utils
+    s3_utils.boto3 = types.SimpleNamespace(client=lambda *a, **kw: s3)
+    s3_utils.clear_s3_clients()
+
+
+def install_stage_timers():
+    """
+    Wrap the stage functions so each job records the time spent in them
+    """
+    for stage, module_name, func_name in STAGES:
+        module = sys.modules[module_name]
+        setattr(module, func_name,
+                time_stage(stage, getattr(module, func_name)))
+
+
+def time_stage(stage, func):
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            stages = getattr(_local, "stages", None)
+            if stages is not None:
+                stages[stage] = stages.get(stage, 0.0) \
+                    + time.perf_counter() - start
+    return wrapper
+
+
+def load_events(path, base_url):
+    """
+    Read runpod events from a JSONL file and point their image urls at the
+    local server. Lines may be full events ({"input": {...}}) or just the
+    input; missing fields are filled with defaults. Lines that aren't
+    events at all are skipped with a warning.
+    """
+    known = set(DEFAULT_INPUT) | set(URL_INPUTS)
+    events = []
+    with open(path) as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                print("WARNING: {}:{} is not valid JSON, skipping it".format(
+                    path, line_number), file=sys.stderr)
+                continue
+            if not isinstance(record, dict):
+                record = {}
+            model_input = record.get("input", record)
+            if not isinstance(model_input, dict) \
+                    or not known & set(model_input):
+                print("WARNING: {}:{} is not an event, skipping it".format(
+                    path, line_number), file=sys.stderr)
+                continue
+            unused = sorted(set(model_input) - known)
+            if unused:
+                print("WARNING: {}:{} ignoring unknown fields {}".format(
+                    path, line_number, ", ".join(unused)), file=sys.stderr)
+            model_input = dict(DEFAULT_INPUT, **{
+                k: v for k, v in model_input.items() if k in DEFAULT_INPUT
+            })
+            model_input["compositeProductUrl"] = \
+                base_url + "images/composite.png"
+            model_input["backgroundUrl"] = base_url + "images/background.png"
+            events.append({"input": model_input})
+    if not events:
+        raise ValueError("No events found in {}".format(path))
+    print("loaded {} events from {}".format(len(events), path))
+    return events
+
+
+def worker_process(worker_id, args, base_url, jobs, results, ready):
+    """
+    One worker: load the stubbed handler and run one job at a time
+    """
+    random.seed(args.seed + worker_id)
+    output = sys.stdout if args.verbose else open(os.devnull, "w")
+    with contextlib.redirect_stdout(output):
+        try:
+            cost_model = CostModel(args.gen_base, args.gen_per_step,
+                                   args.gen_jitter)
+            handler = load_worker(cost_model, base_url, args.env)
+            install_local_s3(LocalS3(base_url))
+            install_stage_timers()
+        except Exception as e:
+            ready.put("worker {} failed to start: {!r}".format(worker_id, e))
+            return
+        ready.put(None)
+
+        while True:
+            item = jobs.get()
+            if item is None:
+                return
+            idx, event, arrival = item
+            _local.stages = {}
+            start = time.monotonic()
+            try:
+                response = handler.handler(event)
+                ok = isinstance(response, dict) \
+                    and "generatedImages" in response
+            except Exception as e:
+                response, ok = str(e), False
+            end = time.monotonic()
+            results.put({
+                "index": idx,
+                "worker": worker_id,
+                "ok": ok,
+                "error": None if ok else str(response),
+                "latency": end - (arrival if arrival is not None else start),
+                "service": end - start,
+                "start": arrival if arrival is not None else start,
+                "end": end,
+                "stages": _local.stages,
+            })
+
+
+def run_load(args, base_url, events, n_requests):
+    """
+    Replay the events through --concurrency worker processes. With a rate
+    the arrivals are open loop and latency includes the time spent waiting
+    for a free worker; without one every worker picks up the next event as
+    soon as it is done.
+    """
+    context = multiprocessing.get_context("spawn")
+    jobs = context.Queue()
+    results = context.Queue()
+    ready = context.Queue()
+    workers = [
+        context.Process(target=worker_process, daemon=True,
+                        args=(i, args, base_url, jobs, results, ready))
+        for i in range(args.concurrency)
+    ]
+    for w in workers:
+        w.start()
+    # wait for every worker to load the handler before sending traffic
+    for _ in workers:
+        error = ready.get()
+        if error:
+            for w in workers:
+                w.terminate()
+            raise RuntimeError(error)
+
+    # time.monotonic is shared between processes, arrivals are stamped here
+    start = time.monotonic()
+    for idx in range(n_requests):
+        event = events[idx % len(events)]
+        arrival = None
+        if args.rate:
+            arrival = start + idx / args.rate
+            time.sleep(max(0.0, arrival - time.monotonic()))
+        jobs.put((idx, event, arrival))
+    for _ in workers:
+        jobs.put(None)
+
+    collected = []
+    while len(collected) < n_requests:
+        try:
+            collected.append(results.get(timeout=1))
+        except queue.Empty:
+            if not any(w.is_alive() for w in workers):
+                raise RuntimeError("workers exited before finishing the run")
+    for w in workers:
+        w.join()
+
+    collected.sort(key=lambda r: r["index"])
+    measured = collected[args.warmup:]
+    elapsed = max(r["end"] for r in measured) \
+        - min(r["start"] for r in measured)
+    return measured, elapsed
+
+
+def percentile(values, pct):
+    """
+    Nearest rank percentile
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    rank = max(1, math.ceil(pct / 100.0 * len(values)))
+    return values[rank - 1]
+
+
+def summarize(results, elapsed, config):
+    latencies = [r["latency"] for r in results if r["ok"]]
+    services = [r["service"] for r in results if r["ok"]]
+    errors = {}
+    for r in results:
+        if not r["ok"]:
+            errors[r["error"]] = errors.get(r["error"], 0) + 1
+
+    stages = {}
+    for stage, _, _ in STAGES:
+        times = [r["stages"][stage] for r in results
+                 if r["ok"] and stage in r["stages"]]
+        if times:
+            stages[stage] = {
+                "mean": sum(times) / len(times),
+                "p50": percentile(times, 50),
+                "p95": percentile(times, 95),
+            }
+
+    return {
+        "config": config,
+        "requests": len(results),
+        "succeeded": len(latencies),
+        "errors": errors,
+        "elapsed": elapsed,
+        "throughput": len(latencies) / elapsed if elapsed else 0.0,
+        "latency": {
+            "mean": sum(latencies) / len(latencies) if latencies else None,
+            "p50": percentile(latencies, 50),
+            "p95": percentile(latencies, 95),
+            "p99": percentile(latencies, 99),
+            "max": max(latencies) if latencies else None,
+        },
+        "service": {
+            "p50": percentile(services, 50),
+            "p95": percentile(services, 95),
+            "p99": percentile(services, 99),
+        },
+        "stages": stages,
+    }
+
+
+def _ms(value):
+    return "-" if value is None else "{:.1f} ms".format(value * 1000)
+
+
+def print_summary(summary):
+    print("requests: {} ok: {} elapsed: {:.2f}s throughput: {:.2f} req/s"
+          .format(summary["requests"], summary["succeeded"],
+                  summary["elapsed"], summary["throughput"]))
+    for error, count in summary["errors"].items():
+        print("  error {!r}: {}".format(error, count))
+    print("latency  p50 {}  p95 {}  p99 {}  max {}".format(
+        *[_ms(summary["latency"][k]) for k in ["p50", "p95", "p99", "max"]]))
+    print("service  p50 {}  p95 {}  p99 {}".format(
+        *[_ms(summary["service"][k]) for k in ["p50", "p95", "p99"]]))
+    print("stages (mean / p95):")
+    for stage, stats in summary["stages"].items():
+        print("  {:<16}{:>12} {:>12}".format(
+            stage, _ms(stats["mean"]), _ms(stats["p95"])))
+
+
+def compare(summary, baseline, threshold):
+    """
+    Print the change against a previous run. Returns True if the success
+    rate dropped, or if any latency or throughput number regressed by more
+    than threshold percent or is missing (e.g. every request failed). Runs
+    with different load parameters are shown but never count as a
+    regression.
+    """
+    config, baseline_config = summary["config"], baseline.get("config", {})
+    differences = [k for k in LOAD_PARAMS
+                   if config.get(k) != baseline_config.get(k)]
+    if differences:
+        print("WARNING: load parameters differ from the baseline, "
+              "not checking for regressions:")
+        for k in differences:
+            print("  {}: {} -> {}".format(
+                k, baseline_config.get(k), config.get(k)))
+
+    rows = [
+        ("success rate", _success_rate(summary), _success_rate(baseline),
+         True),
+        ("throughput", summary["throughput"], baseline["throughput"], True),
+    ]
+    for k in ["p50", "p95", "p99"]:
+        rows.append(("latency " + k, summary["latency"][k],
+                     baseline["latency"][k], False))
+    for stage, stats in summary["stages"].items():
+        if stage in baseline["stages"]:
+            rows.append(("stage " + stage, stats["mean"],
+                         baseline["stages"][stage]["mean"], False))
+
+    regressed = False
+    print("comparison against baseline:")
+    for name, current, previous, higher_is_better in rows:
+        if previous is None:
+            continue
+        if current is None:
+            change, worse = None, float("inf")
+        elif previous:
+            change = (current - previous) / previous * 100
+            worse = -change if higher_is_better else change
+        else:
+            change, worse = None, 0.0
+        # any drop in the success rate counts, failures are never noise
+        limit = 0.0 if name == "success rate" else threshold
+        flag = ""
+        if worse > limit and not differences:
+            flag = "  REGRESSION"
+            if not name.startswith("stage"):
+                regressed = True
+        if name == "success rate":
+            values = "{:.1%} -> {:.1%}".format(previous, current)
+        elif name == "throughput":
+            values = "{:.2f} -> {:.2f} req/s".format(previous, current)
+        else:
+            values = "{} -> {}".format(_ms(previous), _ms(current))
+        change = "n/a" if change is None else "{:+.1f}%".format(change)
+        print("  {:<24}{:<28}{}{}".format(name, values, change, flag))
+    return regressed
+
+
+def _success_rate(summary):
+    if not summary["requests"]:
+        return None
+    return summary["succeeded"] / summary["requests"]
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("events",
+                        help="JSONL file with one runpod event per line")
+    parser.add_argument("--requests", type=int, default=None,
+                        help="number of requests to send (default: one "
+                             "per event in the file)")
+    parser.add_argument("--rate", type=float, default=0,
+                        help="arrival rate in requests/s (0: closed loop)")
+    parser.add_argument("--concurrency", type=int, default=1,
+                        help="number of worker processes, each running one "
+                             "job at a time like a deployed worker")
+    parser.add_argument("--warmup", type=int, default=0,
+                        help="requests left out of the report")
+    parser.add_argument("--gen-base", type=float, default=0.5,
+                        help="fixed seconds per prompt2image call")
+    parser.add_argument("--gen-per-step", type=float, default=0.0,
+                        help="extra seconds per diffusion step")
+    parser.add_argument("--gen-jitter", type=float, default=0.1,
+                        help="relative std dev of the generation time")
+    parser.add_argument("--image-latency", type=float, default=0.0,
+                        help="seconds added to every image download")
+    parser.add_argument("--backend-latency", type=float, default=0.0,
+                        help="seconds added to every backend call")
+    parser.add_argument("--env", default="prod",
+                        help="ENV for the worker; 'prod' calls the backend")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="save the results as JSON")
+    parser.add_argument("--baseline",
+                        help="results of a previous run to compare with")
+    parser.add_argument("--threshold", type=float, default=10.0,
+                        help="percent change counted as a regression")
+    parser.add_argument("--verbose", action="store_true",
+                        help="keep the worker's own logs")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    images = make_test_images()
+    server, backend_calls = start_local_server(
+        images, args.backend_latency, args.image_latency)
+    base_url = "http://127.0.0.1:{}/".format(server.server_address[1])
+
+    events = load_events(args.events, base_url)
+    n_requests = args.requests or len(events)
+    if args.warmup >= n_requests:
+        raise ValueError("--warmup must be smaller than --requests")
+
+    results, elapsed = run_load(args, base_url, events, n_requests)
+    server.shutdown()
+
+    config = {k: v for k, v in vars(args).items()
+              if k not in ["output", "baseline", "verbose"]}
+    # the workers inherit the memory monitor settings, which add overhead
+    config["memory_env"] = {k: v for k, v in sorted(os.environ.items())
+                            if k.startswith("MEMORY_")}
+    summary = summarize(results, elapsed, config)
+    summary["backend_calls"] = len(backend_calls)
+    print_summary(summary)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(summary, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if compare(summary, baseline, args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,298 @@
+import ctypes
+import gc
+import os
+import threading
+import tracemalloc
+from collections import deque
+from functools import wraps
+
+
+def _env_number(name, default, cast=float):
+    # a typo in an opt-in setting must not stop the worker from starting
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    try:
+        return cast(value)
+    except ValueError:
+        print("MEMORY: invalid {}={!r}, using {}".format(name, value, default))
+        return default
+
+
+# opt-in: set MEMORY_MONITOR=1 on the worker to collect memory reports
+MONITOR_ENABLED = os.environ.get("MEMORY_MONITOR", "0") == "1"
+RSS_LIMIT_MB = _env_number("MEMORY_RSS_LIMIT_MB", 0.0)
+GROWTH_JOBS = _env_number("MEMORY_GROWTH_JOBS", 5, int)
+GROWTH_MB = _env_number("MEMORY_GROWTH_MB", 200.0)
+
+_MB = 1024 * 1024
+
+# per job state lives in the thread running the job; RSS history and
+# cleanup bookkeeping are process wide
+_local = threading.local()
+_lock = threading.Lock()
+_active_jobs = 0
+_jobs_seen = 0
+_rss_history = deque(maxlen=max(GROWTH_JOBS, 2))
+_rss_after_cleanup = None
+_cleanup_hooks = []
+
+
+def get_rss_mb():
+    """
+    Current resident set size of this process in MB (None if unavailable)
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            resident_pages = int(f.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return None
+    return round(resident_pages * os.sysconf("SC_PAGE_SIZE") / _MB, 2)
+
+
+def register_cleanup(func):
+    """
+    Register a callable that drops a cache when memory cleanup is triggered
+    """
+    _cleanup_hooks.append(func)
+    return func
+
+
+def start_job():
+    """
+    Reset the per job memory stats. Called at the start of every request.
+    """
+    global _active_jobs
+    if not MONITOR_ENABLED:
+        return None
+    with _lock:
+        _active_jobs += 1
+        overlapped = _active_jobs > 1
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+    _local.peak_stack = []
+    _local.job = {
+        "rss_start_mb": get_rss_mb(),
+        "stages": {},
+        "peak": 0,
+        "overlapped": overlapped,
+    }
+    _reset_peak()
+    return None
+
+
+def track_memory(stage):
+    """
+    Decorator to record RSS and tracemalloc peak of a stage of the job
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not MONITOR_ENABLED or _current_job() is None:
+                return func(*args, **kwargs)
+            try:
+                _enter_stage()
+                rss_before = get_rss_mb()
+            except Exception as e:
+                # the monitor must never fail the job it is watching
+                print("MEMORY: could not track stage {}: {}".format(stage, e))
+                return func(*args, **kwargs)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                try:
+                    peak = _exit_stage()
+                    _record_stage(stage, rss_before, get_rss_mb(), peak)
+                except Exception as e:
+                    print("MEMORY: could not track stage {}: {}".format(
+                        stage, e))
+        return wrapper
+    return decorator
+
+
+def _current_job():
+    return getattr(_local, "job", None)
+
+
+def _reset_peak():
+    # tracemalloc is process wide: while jobs overlap, leave the peak alone
+    # so that one job doesn't wipe out what another one has seen. The peaks
+    # of overlapping jobs are then an upper bound for the whole process.
+    with _lock:
+        if _active_jobs <= 1:
+            tracemalloc.reset_peak()
+        else:
+            _local.job["overlapped"] = True
+
+
+def _enter_stage():
+    # fold the peak seen so far into the enclosing scope before resetting,
+    # so that nested stages don't hide the peak of the outer ones
+    _fold_peak()
+    _local.peak_stack.append(0)
+    _reset_peak()
+
+
+def _exit_stage():
+    _fold_peak()
+    peak = _local.peak_stack.pop()
+    if _local.peak_stack:
+        _local.peak_stack[-1] = max(_local.peak_stack[-1], peak)
+    else:
+        _local.job["peak"] = max(_local.job["peak"], peak)
+    return peak
+
+
+def _fold_peak():
+    peak = tracemalloc.get_traced_memory()[1]
+    if _local.peak_stack:
+        _local.peak_stack[-1] = max(_local.peak_stack[-1], peak)
+    else:
+        _local.job["peak"] = max(_local.job["peak"], peak)
+
+
+def _record_stage(stage, rss_before, rss_after, peak):
+    stats = _local.job["stages"].setdefault(stage, {
+        "calls": 0,
+        "rss_delta_mb": 0.0,
+        "rss_max_mb": 0.0,
+        "traced_peak_mb": 0.0,
+    })
+    stats["calls"] += 1
+    if rss_before is not None and rss_after is not None:
+        stats["rss_delta_mb"] = round(
+            stats["rss_delta_mb"] + rss_after - rss_before, 2)
+        stats["rss_max_mb"] = max(stats["rss_max_mb"], rss_after)
+    stats["traced_peak_mb"] = max(stats["traced_peak_mb"],
+                                  round(peak / _MB, 2))
+
+
+def end_job():
+    """
+    Finish the per job stats, check for leaks and clean up if needed.
+    Returns the memory report for the job (None if monitoring is disabled).
+    """
+    global _active_jobs
+    job = _current_job()
+    if not MONITOR_ENABLED or job is None:
+        return None
+    _local.job = None
+    try:
+        _fold_peak_into(job)
+        return _finish_report(job)
+    except Exception as e:
+        print("MEMORY: could not build the memory report:", e)
+        return None
+    finally:
+        with _lock:
+            _active_jobs -= 1
+
+
+def _fold_peak_into(job):
+    peak = tracemalloc.get_traced_memory()[1]
+    job["peak"] = max([job["peak"], peak] + _local.peak_stack)
+    _local.peak_stack = []
+
+
+def _finish_report(job):
+    global _jobs_seen
+    rss_end = get_rss_mb()
+    with _lock:
+        _jobs_seen += 1
+        job_number = _jobs_seen
+        if rss_end is not None:
+            _rss_history.append(rss_end)
+        growing = is_growing()
+        reason = _cleanup_reason(rss_end, growing)
+
+    report = {
+        "job": job_number,
+        "rss_start_mb": job["rss_start_mb"],
+        "rss_end_mb": rss_end,
+        "traced_peak_mb": round(job["peak"] / _MB, 2),
+        "overlapped": job["overlapped"],
+        "stages": job["stages"],
+        "growth_detected": growing,
+        "cleanup": None,
+    }
+    if reason:
+        print("MEMORY: triggering cleanup ({}) at {} MB".format(
+            reason, rss_end))
+        report["cleanup"] = cleanup(reason)
+    return report
+
+
+def _cleanup_reason(rss_end, growing):
+    if RSS_LIMIT_MB and rss_end is not None and rss_end > RSS_LIMIT_MB:
+        # if a cleanup couldn't bring RSS under the limit (e.g. the model
+        # alone is bigger) only try again once RSS has grown since then
+        if _rss_after_cleanup is None \
+                or rss_end - _rss_after_cleanup > GROWTH_MB:
+            return "rss_limit"
+    if growing:
+        return "steady_growth"
+    return None
+
+
+def is_growing():
+    """
+    Whether RSS went up by more than MEMORY_GROWTH_MB over the last
+    MEMORY_GROWTH_JOBS jobs, using the least squares slope so that
+    allocator noise between jobs doesn't hide a slow leak.
+    """
+    n = len(_rss_history)
+    if n < _rss_history.maxlen:
+        return False
+    mean_x = (n - 1) / 2
+    mean_y = sum(_rss_history) / n
+    covariance = sum((x - mean_x) * (y - mean_y)
+                     for x, y in enumerate(_rss_history))
+    variance = sum((x - mean_x) ** 2 for x in range(n))
+    slope = covariance / variance
+    return slope * (n - 1) > GROWTH_MB
+
+
+def cleanup(reason=None):
+    """
+    Drop registered caches, collect garbage and give freed memory back to
+    the OS.
+    """
+    global _rss_after_cleanup
+    rss_before = get_rss_mb()
+    for hook in _cleanup_hooks:
+        try:
+            hook()
+        except Exception as e:
+            print("MEMORY: cleanup hook failed:", e)
+    collected = gc.collect()
+    _trim_malloc()
+    _empty_cuda_cache()
+    rss_after = get_rss_mb()
+    with _lock:
+        # start the growth window again so we don't clean up after every job
+        _rss_history.clear()
+        _rss_after_cleanup = rss_after
+    return {
+        "reason": reason,
+        "collected_objects": collected,
+        "rss_before_mb": rss_before,
+        "rss_after_mb": rss_after,
+    }
+
+
+def _trim_malloc():
+    try:
+        ctypes.CDLL("libc.so.6").malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+
+
+def _empty_cuda_cache():
+    # release the blocks held by torch's caching allocator; the loaded
+    # model weights themselves stay on the GPU
+    try:
+        import torch
+    except ImportError:
+        return
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
@@ -3,11 +3,13 @@ import cv2
 from blend_modes import multiply
 from PIL import Image, ImageOps, ImageFilter, ImageChops
 from handlers import report_error, validate_request_args
+from memory_utils import track_memory
 import requests
 import os
 from s3_utils import load_image_from_url
 
 
+@track_memory("parse_inputs")
 @validate_request_args
 @report_error(100)
 def parse_model_inputs(model_inputs):
@@ -89,6 +91,7 @@ def erode_image(img, iterations):
     return Image.fromarray(eroded_img)
 
 
+@track_memory("prepare_masks")
 def prepare_masks_differencing_main(original_image, bg,
                                     output_mask_address=None):
     diff = ImageChops.difference(original_image, bg)
@@ -183,6 +186,7 @@ def get_shadow(mask, offset):
     return new_backdrop
 
 
+@track_memory("add_shadow")
 @report_error(210)
 def add_shadow(original_image_mask, composite_image, offset="random"):
     """
@@ -237,6 +241,7 @@ def add_shadow(original_image_mask, composite_image, offset="random"):
     return blended_img_raw
 
 
+@track_memory("notify_backend")
 @report_error(300)
 def send_info_back_to_BE(product_id, background_id, composite_id, keys):
     keys = [i.split("/")[-1] for i in keys]
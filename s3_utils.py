@@ -3,9 +3,13 @@ from PIL import Image
 from io import BytesIO
 import requests
 from handlers import validate_input_image, report_error, validate_s3_client
+from memory_utils import track_memory
 
 BUCKET_NAME = 'fotomaker-engineering'
 
+# one client per set of credentials, reused across jobs
+_s3_clients = {}
+
 
 @validate_input_image
 @report_error(130)
@@ -29,11 +33,27 @@ def create_s3_client(access_key, secret_key):
     return s3_client
 
 
+def get_s3_client(access_key, secret_key):
+    """
+    Reuse the S3 client between jobs instead of creating a new one
+    on every request
+    """
+    credentials = (access_key, secret_key)
+    if credentials not in _s3_clients:
+        _s3_clients[credentials] = create_s3_client(access_key, secret_key)
+    return _s3_clients[credentials]
+
+
+def clear_s3_clients():
+    _s3_clients.clear()
+
+
 def download_file(client, path, bucket_name=BUCKET_NAME):
     client.download_file(bucket_name, path, path.split("/")[-1])
     return None
 
 
+@track_memory("upload")
 @report_error(332)
 def save_images(save_name, imgs, client):
     keys = []
@@ -66,6 +86,7 @@ def save_response_s3(client, file, key):
     return None
 
 
+@track_memory("presign")
 @report_error(333)
 def get_urls(client, keys):
     img_urls = []